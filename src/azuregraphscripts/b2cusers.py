@@ -1,5 +1,33 @@
+import asyncio
+import functools
 import httpx
-from vendor.mggraph import connect_mggraph_application
+import os
+import threading
+import time
+from urllib.parse import parse_qs, quote, urlparse
+from vendor.mggraph import connect_mggraph_application, connect_mggraph_application_async, response_json
+
+_PWD_POLICY = "DisablePasswordExpiration"
+
+# Throttled requests are retried this many times in total
+GRAPH_RETRIES = 5
+RETRY_STATUS_CODES = (429, 503)
+
+def _pwd_profile(password: str) -> dict:
+    """
+        Builds the passwordProfile object used when creating a user or changing a password
+
+    Args:
+        password (str): The password to set
+
+    Returns:
+        dict: The passwordProfile object
+    """
+
+    return {
+        "password": password,
+        "forceChangePasswordNextSignIn": False,
+    }
 
 class User:
     base_user_attributes = [
@@ -21,8 +49,6 @@ class User:
         "ObjectId",
     ]
     
-    custom_user_attributes = []
-    
     def __init__(
         self,
         app_id: str,
@@ -44,8 +70,18 @@ class User:
 
         self.tenant_name = tenant_name
         self.api_url = api_url
+
+        # Local account identity, only the issuerAssignedId differs per user
+        self._identity_template = {
+            "issuer": self.tenant_name,
+            "signInType": "emailAddress",
+        }
         
         self.graph_connection = connect_mggraph_application(app_id, secret, tenant_id, api_url)
+
+        # The async connection is only needed by list_async, so it is created on first use
+        self.async_graph_connection = None
+        self._connect_async = functools.partial(connect_mggraph_application_async, app_id, secret, tenant_id, api_url)
         
         """
             Extension attributes are always in the format "extension_<b2c app id>_<extension name>"
@@ -57,16 +93,18 @@ class User:
         """
 
         # Fetch all the userflow_user_attributes
-        extension_user_attributes = self.graph_connection.get(
+        extension_user_attributes = response_json(self._get_cache_first(
             f"{self.api_url}/identity/userFlowAttributes"
-        ).json()
+        ))
 
         self.userflow_user_attributes = [
             extension["id"] for extension in extension_user_attributes["value"]
         ]
 
-        # Prepare the userflow attribute mappings
+        # Prepare the userflow attribute mappings. Custom attributes are kept per instance so
+        # multiple User objects (eg. for different tenants) do not share them
         self.userflow_attribute_mapping = {}
+        custom_user_attributes = []
 
         for extension in extension_user_attributes["value"]:
             if extension["userFlowAttributeType"] == "builtIn":
@@ -76,16 +114,130 @@ class User:
                 extension_id = extension["id"]
                 
                 # Save to a list of only custom attributes and add it to the complete mapping file
-                self.custom_user_attributes.append(extension_id)
+                custom_user_attributes.append(extension_id)
                 self.userflow_attribute_mapping[extension_displayname] = extension_id
 
+        # Lookup tables used when remapping records returned by the graph api
+        self._reversed_mapping = {v:k for k,v in self.userflow_attribute_mapping.items()}
+        self._custom_attrs_set = frozenset(custom_user_attributes)
+        self._unwanted_set = frozenset(self.unwanted_attributes)
+
+        # Generated remap functions per set of selected attributes and returned fields, see _remapper
+        self._remap_functions = {}
+
         # Combine all user attributes
         self.all_user_attributes = (
             self.base_user_attributes
             + self.extended_user_attributes
             + self.userflow_user_attributes
         )
+
+        # Default $select value for profile()
+        self._all_attrs_csv = ','.join(self.all_user_attributes)
+
+        # The graph api accepts $select names in any casing but returns its own spelling. Used to
+        # normalise attribute names passed by callers
+        self._canonical_attributes = {attribute.lower(): attribute for attribute in self.all_user_attributes}
     
+    def _req(self, method: str, url: str, **kwargs) -> httpx.Response:
+        """
+            Perform a request on the graph connection, retrying when we are throttled
+
+            The graph api throttles with a 429 or 503 status code. We honour the Retry-After header
+            when it is sent, otherwise we back off exponentially.
+
+        Args:
+            method (str): The http method, eg. get, post, patch or delete
+            url (str): The url to call
+            **kwargs: Passed on to the httpx request
+
+        Returns:
+            httpx.Response: The last response received
+        """
+
+        for attempt in range(GRAPH_RETRIES):
+            response = getattr(self.graph_connection, method)(url, **kwargs)
+
+            if response.status_code not in RETRY_STATUS_CODES or attempt == GRAPH_RETRIES - 1:
+                return response
+
+            time.sleep(float(response.headers.get("Retry-After", 2 ** attempt)))
+
+    async def _req_async(self, connection: httpx.AsyncClient, method: str, url: str, **kwargs) -> httpx.Response:
+        """
+            Async version of _req
+
+        Args:
+            connection (httpx.AsyncClient): The async client to use
+            method (str): The http method, eg. get, post, patch or delete
+            url (str): The url to call
+            **kwargs: Passed on to the httpx request
+
+        Returns:
+            httpx.Response: The last response received
+        """
+
+        for attempt in range(GRAPH_RETRIES):
+            response = await getattr(connection, method)(url, **kwargs)
+
+            if response.status_code not in RETRY_STATUS_CODES or attempt == GRAPH_RETRIES - 1:
+                return response
+
+            await asyncio.sleep(float(response.headers.get("Retry-After", 2 ** attempt)))
+
+    def _get_cache_first(self, url: str) -> httpx.Response:
+        """
+            GET a url that rarely changes, serving it from the cache when possible
+
+            If a cached 200 response exists it is returned immediately, even when stale, and the cache
+            is refreshed in a background thread. Otherwise a normal request is done, which is retried
+            when throttled and only cached when successful.
+
+        Args:
+            url (str): The url to fetch
+
+        Returns:
+            httpx.Response: The cached or freshly fetched response
+        """
+
+        # force_cache serves a stored response regardless of its freshness. only-if-cached makes
+        # hishel answer a miss with a 504 without touching the network.
+        response = self.graph_connection.get(
+            url,
+            headers={"Cache-Control": "only-if-cached"},
+            extensions={"force_cache": True}
+        )
+
+        if not (response.extensions.get("from_cache") and response.status_code == 200):
+            # The graph api marks its responses no-cache, force_cache is needed to store them at all.
+            # The cache controller only stores a 200, so throttled attempts are retried on the network.
+            return self._req("get", url, extensions={"force_cache": True})
+
+        # Revalidating an existing entry stores the new response, whatever its cache headers are
+        threading.Thread(
+            target=self._req,
+            args=("get", url),
+            kwargs={"headers": {"Cache-Control": "no-cache"}},
+            daemon=True
+        ).start()
+
+        return response
+
+    async def aclose(self) -> None:
+        """
+            Closes the async connection used by list_async, if it was created
+        """
+
+        if self.async_graph_connection is not None:
+            await self.async_graph_connection.aclose()
+            self.async_graph_connection = None
+
+    async def __aenter__(self) -> "User":
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self.aclose()
+
     def get_attributes(self) -> list:
         """
             == User attributes [CACHEABLE]
@@ -101,13 +253,6 @@ class User:
             list: A list of all base, extended and userflow user attributes
         """
 
-        # Combine all user attributes
-        self.all_user_attributes = (
-            self.base_user_attributes
-            + self.extended_user_attributes
-            + self.userflow_user_attributes
-        )
-        
         return self.all_user_attributes
 
     def search(self, email: str) -> dict:
@@ -120,17 +265,16 @@ class User:
         Returns:
             dict: user object if found, else empty object
         """
+
+        email = quote(email, safe='')
         
-        import urllib.parse
-        email = urllib.parse.quote(email)
-        
-        searchresult = self.graph_connection.get(
+        searchresult = response_json(self._req("get",
             f"{self.api_url}/users?$filter=(identities/any(i:i/issuer eq '{self.tenant_name}' and i/issuerAssignedId eq '{email}'))&$select=id,identities"
-        ).json()
+        ))
 
         return searchresult['value']
 
-    def list(self, max: int = 0, include_attributes: list = []) -> dict:
+    def list(self, max: int = 0, include_attributes: list = [], attributes: list = None) -> dict:
         """
             This fetches a list of all users (paged per 1000 users)
             This does not contain all information, only the most basic information
@@ -141,12 +285,213 @@ class User:
         Args:
             max (int, optional): Max number of accounts to fetch. If 0 return all accounts. Defaults to 999.
             include_attributes (list, optional): List of added attributes to fetch on top of the default attributes. Defaults to [].
+            attributes (list, optional): Graph api attribute names that replace the default attributes instead of adding to them. Make sure to include id. Defaults to None.
+
+        Returns:
+            dict: Object containing a paginated list of users
+        """
+
+        if(max < 0 or max > 999):
+            raise Exception("max value should be between 0 and 999")
+
+        if(max == 0):
+            return list(self.iter_list(include_attributes, attributes))
+
+        params = self._list_params(include_attributes, attributes)
+        params["$top"] = max
+
+        fetch_customers = response_json(self._req("get", f"{self.api_url}/users", params=params))
+
+        remap = self._remapper(params["$select"])
+
+        return [remap(customer) for customer in fetch_customers['value']]
+
+    async def list_async(self, max: int = 0, include_attributes: list = [], attributes: list = None) -> dict:
+        """
+            Async version of list
+
+            While a page is being remapped in a worker thread, the request for the next page is
+            already in flight on the event loop.
+
+            Uses async_graph_connection which bypasses the request cache. It is created on first use
+            and its pooled connections are bound to one event loop, so call this from a single long
+            running loop rather than from repeated asyncio.run calls. Use list from synchronous code.
+
+            Close the connection with aclose, or use the User object as an async context manager:
+
+                async with User(...) as users:
+                    customers = await users.list_async()
+
+        Args:
+            max (int, optional): Max number of accounts to fetch. If 0 return all accounts. Defaults to 999.
+            include_attributes (list, optional): List of added attributes to fetch on top of the default attributes. Defaults to [].
+            attributes (list, optional): Graph api attribute names that replace the default attributes instead of adding to them. Make sure to include id. Defaults to None.
 
         Returns:
             dict: Object containing a paginated list of users
         """
 
-        attributes_to_fetch = set(self.base_user_attributes)
+        if(max < 0 or max > 999):
+            raise Exception("max value should be between 0 and 999")
+
+        params = self._list_params(include_attributes, attributes)
+        params["$top"] = 999 if max == 0 else max
+
+        if self.async_graph_connection is None:
+            self.async_graph_connection = self._connect_async()
+
+        # Fix fieldnames in returned list
+        remap = self._remapper(params["$select"])
+        mapped_customers = []
+
+        next_page = asyncio.create_task(
+            self._req_async(self.async_graph_connection, "get", f"{self.api_url}/users", params=params)
+        )
+
+        while next_page is not None:
+            fetch_customers = response_json(await next_page)
+            next_page = None
+
+            # Only follow the nextLink when fetching all accounts
+            if max == 0 and "@odata.nextLink" in fetch_customers:
+                next_page = asyncio.create_task(
+                    self._req_async(self.async_graph_connection, "get", fetch_customers['@odata.nextLink'])
+                )
+
+            # Remap off the event loop so the loop can keep working on the next page meanwhile
+            mapped_customers.extend(
+                await asyncio.to_thread(list, map(remap, fetch_customers['value']))
+            )
+        
+        return mapped_customers
+
+    def iter_list(self, include_attributes: list = [], attributes: list = None):
+        """
+            Same as list with max = 0 but yields the users one page at a time instead of building
+            the complete list in memory. Use this for large tenants.
+
+        Args:
+            include_attributes (list, optional): List of added attributes to fetch on top of the default attributes. Defaults to [].
+            attributes (list, optional): Graph api attribute names that replace the default attributes instead of adding to them. Make sure to include id. Defaults to None.
+
+        Yields:
+            dict: A single remapped user
+        """
+
+        params = self._list_params(include_attributes, attributes)
+        params["$top"] = 999
+
+        remap = self._remapper(params["$select"])
+
+        fetch_customers = response_json(self._req("get", f"{self.api_url}/users", params=params))
+
+        yield from map(remap, fetch_customers['value'])
+
+        while "@odata.nextLink" in fetch_customers:
+            fetch_customers = response_json(self._req("get", fetch_customers['@odata.nextLink']))
+            yield from map(remap, fetch_customers['value'])
+
+    def list_delta(self, state_token: str = None, include_attributes: list = [], state_file: str = None) -> tuple:
+        """
+            Fetch only the users that changed since the previous call using the delta query endpoint
+
+            The first run (without a state token) returns all users together with a delta token. Passing
+            that token in a following run only returns users that were created, updated or deleted in the
+            meantime. Deleted users contain the `@removed` attribute.
+
+            Delta queries do not support filtering on creationType so, unlike list, all user types are
+            returned. The selected attributes are stored in the delta token by the graph api so
+            include_attributes is only used on the first run.
+
+            When the delta token has expired the graph api answers with a 410. The token is then
+            dropped and a full sync is done, which returns all users and a fresh delta token. Any other
+            error raises an exception and leaves the state file untouched.
+
+            https://learn.microsoft.com/en-us/graph/delta-query-users
+
+        Args:
+            state_token (str, optional): The delta token returned by the previous run. Defaults to None.
+            include_attributes (list, optional): List of added attributes to fetch on top of the default attributes. Defaults to [].
+            state_file (str, optional): File to read the delta token from and write the new delta token to. Defaults to None.
+
+        Returns:
+            tuple: A list of changed users and the new delta token
+        """
+
+        if state_token is None and state_file is not None and os.path.isfile(state_file):
+            with open(state_file) as file:
+                state_token = file.read().strip() or None
+
+        while True:
+            if state_token is None:
+                params = self._list_params(include_attributes)
+                params.pop("$filter")
+            else:
+                params = {"$deltatoken": state_token}
+
+            changed_customers = []
+            resync_required = False
+            response = self._req("get", f"{self.api_url}/users/delta", params=params)
+
+            while True:
+                # An expired delta token results in a 410, the graph api then wants a full sync again
+                if response.status_code == 410 and state_token is not None:
+                    resync_required = True
+                    break
+
+                if response.status_code != 200:
+                    raise Exception(f"Delta query failed with status {response.status_code}: {response.text}")
+
+                fetch_customers = response_json(response)
+                changed_customers.extend(self._remap(customer) for customer in fetch_customers['value'])
+
+                if "@odata.nextLink" not in fetch_customers:
+                    break
+
+                response = self._req("get", fetch_customers['@odata.nextLink'])
+
+            if resync_required:
+                state_token = None
+                continue
+
+            break
+
+        if "@odata.deltaLink" not in fetch_customers:
+            raise Exception("Delta query did not return a deltaLink")
+
+        delta_link = urlparse(fetch_customers['@odata.deltaLink'])
+        new_state_token = parse_qs(delta_link.query)['$deltatoken'][0]
+
+        # Only persist the token once the complete delta round succeeded
+        if state_file is not None:
+            with open(state_file, "w") as file:
+                file.write(new_state_token)
+
+        return changed_customers, new_state_token
+
+    def _list_params(self, include_attributes: list, attributes: list = None) -> dict:
+        """
+            Builds the query parameters shared by list_async and iter_list
+
+        Args:
+            include_attributes (list): List of added attributes to fetch on top of the default attributes
+            attributes (list, optional): Graph api attribute names that replace the default attributes. Must contain
+                id. Known attributes are normalised to the spelling the graph api returns. Defaults to None.
+
+        Returns:
+            dict: The $select and $filter query parameters
+        """
+
+        if attributes is None:
+            attributes_to_fetch = set(self.base_user_attributes)
+        else:
+            # Only request what the caller needs, every extra attribute makes each page larger
+            attributes_to_fetch = {
+                self._canonical_attributes.get(attribute.lower(), attribute) for attribute in attributes
+            }
+
+            if "id" not in attributes_to_fetch:
+                raise ValueError("attributes should at least contain id")
         
         for include_attribute in include_attributes:
 
@@ -155,57 +500,92 @@ class User:
             
             attributes_to_fetch.add(self.userflow_attribute_mapping[include_attribute])
 
-        needed_attributes = ','.join(attributes_to_fetch)
+        return {
+            "$select": ','.join(attributes_to_fetch),
+            "$filter": "creationType eq 'LocalAccount'"
+        }
+
+    def _remapper(self, select: str):
+        """
+            Returns a function that remaps a user record returned for the given $select
 
-        if(max == 0):
-            all_customers = []
-            
-            fetch_customers = self.graph_connection.get(
-                f"{self.api_url}/users",
-                params={
-                    "$select": needed_attributes,
-                    "$top": 999,
-                    "$filter": "creationType eq 'LocalAccount'"
-                }
-            ).json()
-            
-            all_customers.extend(fetch_customers['value'])
-            
-            while "@odata.nextLink" in fetch_customers:
-                next_link = fetch_customers['@odata.nextLink']
-                fetch_customers = self.graph_connection.get(next_link).json()
-                all_customers.extend(fetch_customers['value'])
-            
-        elif(max <= 999):
-            all_customers = self.graph_connection.get(
-                f"{self.api_url}/users",
-                params={
-                    "$select": needed_attributes,
-                    "$top": max,
-                    "$filter": "creationType eq 'LocalAccount'"
-                }
-            ).json()
-        else:
-            raise Exception("max value should be between 0 and 999")
+            Records returned for the same $select have the same fields, apart from extension
+            attributes without a value which the graph api leaves out. For every distinct set of
+            returned fields we generate a function with all field names and their mapped names
+            hardcoded. This avoids a lookup per field per user.
 
-        # Fix fieldnames in returned list
-        mapped_customers = []
-        reversed_mapping = {v:k for k,v in self.userflow_attribute_mapping.items()}
-        
-        # Loop all records, if a field is an extension attribute map it and pop it from the dict
-        for customer in all_customers:
-            
-            remapped_customer = {}
-            
-            for attribute,value in customer.items():
-                if attribute in self.custom_user_attributes:
-                    remapped_customer[reversed_mapping[attribute]] = value
-                else:
-                    remapped_customer[attribute] = value
-            
-            mapped_customers.append(remapped_customer)
-        
-        return mapped_customers
+            All returned fields are kept with the spelling the graph api uses. Selected attributes
+            that are missing in a record are set to None. The graph api treats $select names case
+            insensitively, so a selected attribute counts as returned regardless of its casing.
+
+        Args:
+            select (str): The comma separated $select value of the request
+
+        Returns:
+            Callable[[dict], dict]: Function that takes a user record and returns the remapped record
+        """
+
+        selected = frozenset(select.split(','))
+
+        # Generated functions per tuple of returned fields, shared by all calls with this $select
+        remap_functions = self._remap_functions.setdefault(selected, {})
+
+        def remap(customer: dict) -> dict:
+            returned_fields = tuple(customer)
+
+            remap_function = remap_functions.get(returned_fields)
+            if remap_function is None:
+                remap_function = remap_functions[returned_fields] = self._generate_remap(selected, returned_fields)
+
+            return remap_function(customer)
+
+        return remap
+
+    def _generate_remap(self, selected: frozenset, returned_fields: tuple):
+        """
+            Generates the remap function used by _remapper for one set of returned fields
+
+        Args:
+            selected (frozenset): The attributes in the $select of the request
+            returned_fields (tuple): The fields of a returned user record, in order
+
+        Returns:
+            Callable[[dict], dict]: Function that takes a user record and returns the remapped record
+        """
+
+        fields = ""
+
+        for attribute in returned_fields:
+            mapped_attribute = self._reversed_mapping[attribute] if attribute in self._custom_attrs_set else attribute
+            fields += f"        {mapped_attribute!r}: customer[{attribute!r}],\n"
+
+        returned_lower = {attribute.lower() for attribute in returned_fields}
+
+        for attribute in sorted(selected):
+            if attribute.lower() not in returned_lower:
+                mapped_attribute = self._reversed_mapping[attribute] if attribute in self._custom_attrs_set else attribute
+                fields += f"        {mapped_attribute!r}: None,\n"
+
+        namespace = {}
+        exec(f"def remap(customer):\n    return {{\n{fields}    }}\n", namespace)
+
+        return namespace["remap"]
+
+    def _remap(self, customer: dict) -> dict:
+        """
+            If a field is an extension attribute map it back to its display name
+
+        Args:
+            customer (dict): A user record as returned by the graph api
+
+        Returns:
+            dict: The user record with remapped fieldnames
+        """
+
+        return {
+            (self._reversed_mapping[attribute] if attribute in self._custom_attrs_set else attribute): value
+            for attribute,value in customer.items()
+        }
 
     def profile(self, userid: str, user_attributes: list = None) -> dict:
         """
@@ -237,12 +617,88 @@ class User:
             dict: Object containing all relevant user data
         """
 
-        if user_attributes is None:
-            user_attributes = self.all_user_attributes
+        select = self._all_attrs_csv if user_attributes is None else ','.join(user_attributes)
+
+        graph_user_profile = response_json(self._req("get",
+            f"{self.api_url}/users/{userid}?$select={select}"
+        ))
+
+        return self._map_profile(graph_user_profile)
+
+    def profile_many(self, userids: list, user_attributes: list = None) -> dict:
+        """
+            Fetch the full user profile of multiple users
+
+            Uses the graph api $batch endpoint which accepts up to 20 requests per call. This saves a
+            round trip per user compared to calling profile() in a loop.
+
+            https://learn.microsoft.com/en-us/graph/json-batching
+
+        Args:
+            userids (list): The user ids/uuids/object ids from Azure/Entra
+            user_attributes (list): List of wanted user attributes. Defaults to all_user_attributes
+
+        Returns:
+            dict: Object containing all relevant user data per user id. None if the user could not be
+                fetched, eg. when it does not exist or is still throttled after all retries
+        """
+
+        select = self._all_attrs_csv if user_attributes is None else ','.join(user_attributes)
+
+        user_profiles = {}
+        pending_userids = list(userids)
+
+        for attempt in range(GRAPH_RETRIES):
+            throttled_userids = []
+            retry_after = 0
+
+            for chunk_start in range(0, len(pending_userids), 20):
+                chunk = pending_userids[chunk_start:chunk_start + 20]
+
+                batch = response_json(self._req("post",
+                    f"{self.api_url}/$batch",
+                    json={
+                        "requests": [
+                            {"id": str(index), "method": "GET", "url": f"/users/{userid}?$select={select}"}
+                            for index, userid in enumerate(chunk)
+                        ]
+                    }
+                ))
+
+                # Responses are not guaranteed to be in the same order as the requests
+                for response in batch["responses"]:
+                    userid = chunk[int(response["id"])]
+
+                    if 200 <= response["status"] < 300:
+                        user_profiles[userid] = self._map_profile(response["body"])
+                    elif response["status"] in RETRY_STATUS_CODES and attempt < GRAPH_RETRIES - 1:
+                        # Throttling is applied per sub request, the batch itself still returns a 200
+                        headers = {k.lower(): v for k, v in response.get("headers", {}).items()}
+                        retry_after = max(retry_after, float(headers.get("retry-after", 2 ** attempt)))
+                        throttled_userids.append(userid)
+                    else:
+                        user_profiles[userid] = None
+
+            if not throttled_userids:
+                break
+
+            # Resend the throttled requests in the next batches
+            time.sleep(retry_after)
+            pending_userids = throttled_userids
+
+        # Keep the order of the given userids, retried users were answered later
+        return {userid: user_profiles[userid] for userid in userids}
+
+    def _map_profile(self, graph_user_profile: dict) -> dict:
+        """
+            Maps a user object returned by the graph api to our own user profile object
 
-        graph_user_profile = self.graph_connection.get(
-            f"{self.api_url}/users/{userid}?$select={','.join(user_attributes)}"
-        ).json()
+        Args:
+            graph_user_profile (dict): A user object as returned by the graph api
+
+        Returns:
+            dict: Object containing all relevant user data
+        """
 
         """ 
             First we do a full mapping with all extension attributes. Then we remove the attributes that 
@@ -258,18 +714,12 @@ class User:
             you have to store it via put/patch to the /users endpoint
         """
 
-        user_profile = {}
-
-        for attribute, mapped_attribute in self.userflow_attribute_mapping.items():
-            user_profile[attribute] = (
-                graph_user_profile[mapped_attribute]
-                if mapped_attribute in graph_user_profile
-                else None
-            )
-
-        # Remove certain attributes from the object
-        for attribute in self.unwanted_attributes:
-            user_profile.pop(attribute, "")
+        # Map all attributes and leave out the ones we do not want in the object
+        user_profile = {
+            attribute: graph_user_profile.get(mapped_attribute)
+            for attribute, mapped_attribute in self.userflow_attribute_mapping.items()
+            if attribute not in self._unwanted_set
+        }
 
         return user_profile
 
@@ -284,9 +734,6 @@ class User:
             dict: A dictionairy containing the newly created user
         """
 
-        # First map the known fields, extension attributes
-        mapped_new_user = {}
-
         """
             We start with an input object like we provided before. Most fields are not required. Apart 
             from the main object, the following attributes are required:
@@ -307,32 +754,45 @@ class User:
             Setting a display name is not required but encouraged.
         """
 
-        for attribute, mapped_attribute in self.userflow_attribute_mapping.items():
-            if attribute in user:
-                mapped_new_user[mapped_attribute] = user[attribute]
-
-        mapped_new_user["displayName"] = user.get("displayName", f"{user.get("givenName")} {user.get("surname")}")
-        mapped_new_user["mail"] = user["email"]
-        mapped_new_user["accountEnabled"] = True
-        mapped_new_user["passwordPolicies"] = "DisablePasswordExpiration"
-        mapped_new_user["passwordProfile"] = {
-            "password": user["password"],
-            "forceChangePasswordNextSignIn": False,
+        # First map the known fields, extension attributes
+        mapped_user = self._map_user_input(user)
+
+        mapped_new_user = {
+            **mapped_user,
+            "displayName": user.get("displayName", f"{user.get('givenName')} {user.get('surname')}"),
+            "mail": user["email"],
+            "accountEnabled": True,
+            "passwordPolicies": _PWD_POLICY,
+            "passwordProfile": _pwd_profile(user["password"]),
+            "identities": [
+                {**self._identity_template, "issuerAssignedId": user["email"]}
+            ],
         }
-        mapped_new_user["identities"] = [
-            {
-                "issuer": self.tenant_name,
-                "issuerAssignedId": user["email"],
-                "signInType": "emailAddress",
-            }
-        ]
 
-        create_user = self.graph_connection.post(
+        create_user = response_json(self._req("post",
             f"{self.api_url}/users", json=mapped_new_user
-        ).json()
+        ))
         
         return create_user
 
+    def _map_user_input(self, user: dict) -> dict:
+        """
+            Maps the known fields of a user object to their graph api attribute names. Unknown fields
+            are left out.
+
+        Args:
+            user (dict): User data using the userflow attribute names
+
+        Returns:
+            dict: User data using the graph api attribute names
+        """
+
+        return {
+            self.userflow_attribute_mapping[attribute]: value
+            for attribute, value in user.items()
+            if attribute in self.userflow_attribute_mapping
+        }
+
     def update(self, userid: str, user: dict) -> bool:
         """
             Update a user
@@ -354,13 +814,9 @@ class User:
         """
 
         # First map the known fields, extension attributes
-        mapped_updated_customer = {}
-
-        for attribute, mapped_attribute in self.userflow_attribute_mapping.items():
-            if attribute in user:
-                mapped_updated_customer[mapped_attribute] = user[attribute]
+        mapped_updated_customer = self._map_user_input(user)
 
-        update_user = self.graph_connection.patch(
+        update_user = self._req("patch",
             f"{self.api_url}/users/{userid}", json=mapped_updated_customer
         )
 
@@ -377,7 +833,7 @@ class User:
             bool: True if the user was deleted
         """
 
-        delete_user = self.graph_connection.delete(f"{self.api_url}/users/{userid}")
+        delete_user = self._req("delete", f"{self.api_url}/users/{userid}")
 
         return bool(delete_user)
 
@@ -398,12 +854,9 @@ class User:
         """
 
         user = {}
-        user["passwordProfile"] = {
-            "password": password,
-            "forceChangePasswordNextSignIn": False,
-        }
+        user["passwordProfile"] = _pwd_profile(password)
                 
-        update_password = self.graph_connection.patch(
+        update_password = self._req("patch",
             f"{self.api_url}/users/{userid}", json=user
         )
 
@@ -1,11 +1,112 @@
 import hishel
 import httpx
+import orjson
 import sqlite3
+import threading
+import time
 from datetime import datetime, timedelta
 import webbrowser
 
-# cache_storage = hishel.SQLiteStorage(connection=sqlite3.connect(".request-cache", timeout=5))
-cache_storage = hishel.FileStorage(ttl=3600)
+# One sqlite file instead of a file per cached response. WAL + synchronous=NORMAL keeps
+# writes cheap and lets readers work alongside the writer, mmap speeds up cache hits
+cache_connection = sqlite3.connect(".request-cache", timeout=5, check_same_thread=False)
+cache_connection.execute("PRAGMA journal_mode=WAL")
+cache_connection.execute("PRAGMA synchronous=NORMAL")
+cache_connection.execute("PRAGMA mmap_size=268435456")
+
+# Same schema hishel creates, plus the indexes it lacks. cache_key is used by every lookup,
+# cache_date_created by the expiry purge and the size trim in CappedSQLiteStorage
+cache_connection.execute("CREATE TABLE IF NOT EXISTS cache(key TEXT, data BLOB, date_created REAL)")
+cache_connection.execute("CREATE INDEX IF NOT EXISTS cache_key ON cache(key)")
+cache_connection.execute("CREATE INDEX IF NOT EXISTS cache_date_created ON cache(date_created)")
+cache_connection.commit()
+
+class CappedSQLiteStorage(hishel.SQLiteStorage):
+    """hishel SQLiteStorage that keeps at most max_entries responses
+
+    hishel rewrites an entry every time it is served from the cache, which updates date_created.
+    Dropping the entries with the oldest date_created therefore evicts the least recently used ones.
+
+    hishel also calls store on every cache hit, so the trim only runs every trim_every stores. The
+    cache can temporarily hold up to trim_every entries more than max_entries.
+
+    The expiry purge is rewritten to compare date_created directly, hishel's
+    `date_created + ttl < now` cannot use the index.
+    """
+
+    def __init__(self, *args, max_entries: int = 10000, trim_every: int = 100, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._max_entries = max_entries
+        self._trim_every = trim_every
+        self._stores_since_trim = 0
+
+    def store(self, key, response, request, metadata) -> None:
+        super().store(key, response, request, metadata)
+
+        with self._lock:
+            self._stores_since_trim += 1
+            if self._stores_since_trim < self._trim_every:
+                return
+
+            self._stores_since_trim = 0
+            self._connection.execute(
+                "DELETE FROM cache WHERE rowid IN (SELECT rowid FROM cache ORDER BY date_created DESC LIMIT -1 OFFSET ?)",
+                [self._max_entries]
+            )
+            self._connection.commit()
+
+    def _remove_expired_caches(self) -> None:
+        assert self._connection
+        if self._ttl is None:
+            return
+
+        with self._lock:
+            self._connection.execute("DELETE FROM cache WHERE date_created < ?", [time.time() - self._ttl])
+            self._connection.commit()
+
+cache_storage = CappedSQLiteStorage(connection=cache_connection, ttl=3600, max_entries=10000, trim_every=100)
+
+class StatusCheckedController(hishel.Controller):
+    """hishel Controller that never caches a status code outside cacheable_status_codes
+
+    hishel caches anything requested with the force_cache extension, including throttled or failed
+    responses. The graph api marks its responses no-cache, so force_cache is the only way to store
+    them and we need the status code check to still apply.
+    """
+
+    def is_cachable(self, request, response) -> bool:
+        if response.status not in self._cacheable_status_codes:
+            return False
+
+        return super().is_cachable(request=request, response=response)
+
+# Allow serving stale responses so callers can read from the cache first and refresh afterwards
+cache_controller = StatusCheckedController(
+    cacheable_methods=["GET"],
+    cacheable_status_codes=[200],
+    allow_stale=True,
+    always_revalidate=False
+)
+
+# Shared client for the token endpoints so consecutive calls reuse the same TLS connection
+login_client = httpx.Client(base_url="https://login.microsoftonline.com", timeout=20.0, http2=True)
+
+# Application tokens per (tenant_id, app_id) as (access_token, expires_at) so new connections
+# within the same process do not request a new token every time
+token_cache: dict[tuple, tuple[str, float]] = {}
+token_lock = threading.Lock()
+
+def response_json(response: httpx.Response):
+    """Decode a json response body with orjson, which is a lot faster than the stdlib json module httpx uses
+
+    Args:
+        response (httpx.Response): The response to decode
+
+    Returns:
+        dict | list: The decoded json body
+    """
+
+    return orjson.loads(response.content)
 
 def connect_mggraph_devicecode(
         app_id: str,
@@ -30,15 +131,15 @@ def connect_mggraph_devicecode(
     
     now = datetime.now()
     
-    request_token = httpx.post(
-        f"https://login.microsoftonline.com/{tenant_id}/oauth2/v2.0/devicecode",
+    request_token = response_json(login_client.post(
+        f"/{tenant_id}/oauth2/v2.0/devicecode",
         data={
             "scope": " ".join(scopes),
             "client_id": app_id
         },
-    ).json()
+    ))
     
-    code_validity = datetime.strftime(now + timedelta(seconds=request_token['expires_in']), "%Y-%m-%d %H:%M:%S")
+    code_validity = (now + timedelta(seconds=request_token['expires_in'])).isoformat(sep=' ', timespec='seconds')
     
     device_code = request_token['device_code']
 
@@ -52,14 +153,14 @@ def connect_mggraph_devicecode(
     
     input("Press Enter once you have logged in with your device code")
     
-    token = httpx.post(
-    f"https://login.microsoftonline.com/{tenant_id}/oauth2/v2.0/token",
+    token = response_json(login_client.post(
+    f"/{tenant_id}/oauth2/v2.0/token",
     data={
         "grant_type": "urn:ietf:params:oauth:grant-type:device_code",
         "client_id": app_id,
         "device_code": device_code
     },
-    ).json()
+    ))
     
     if "error" in token:
         if "7000218" in token['error_codes']:
@@ -71,13 +172,16 @@ def connect_mggraph_devicecode(
     
     connection = hishel.CacheClient(
         storage=cache_storage,
+        controller=cache_controller,
         base_url=api_url,
         headers= {
             "Authorization": f"Bearer {token['access_token']}",
-            # "ConsistencyLevel": "eventual",      # Needed for advanced queries
+            "ConsistencyLevel": "eventual",        # Needed for advanced queries
             # "Prefer": "return=representation",   # To get the object back with a PATCH
         },
-        timeout=20.0
+        timeout=20.0,
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=50, max_connections=100)
     )
     
     return connection
@@ -101,27 +205,99 @@ def connect_mggraph_application(
         hishel.CacheClient: Superset of Httpx Session/Client object ready to use
     """ 
     
-    token = httpx.post(
-        f"https://login.microsoftonline.com/{tenant_id}/oauth2/v2.0/token",
-        data={
-            "scope": "https://graph.microsoft.com/.default",
-            "grant_type": "client_credentials",
-            "client_id": app_id,
-            "client_secret": secret,
-        },
-    ).json()
+    access_token = get_application_token(app_id, secret, tenant_id)
     
     # connection = httpx.Client(
         
     connection = hishel.CacheClient(
         storage=cache_storage,
+        controller=cache_controller,
         base_url=api_url,
         headers= {
-            "Authorization": f"Bearer {token['access_token']}",
-            # "ConsistencyLevel": "eventual",      # Needed for advanced queries
+            "Authorization": f"Bearer {access_token}",
+            "ConsistencyLevel": "eventual",        # Needed for advanced queries
             # "Prefer": "return=representation",   # To get the object back with a PATCH
         },
-        timeout=20.0
+        timeout=20.0,
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=50, max_connections=100)
     )    
      
-    return connection
\ No newline at end of file
+    return connection
+
+def connect_mggraph_application_async(
+        app_id: str,
+        secret: str,
+        tenant_id: str,
+        api_url: str = "https://graph.microsoft.com/v1.0"
+    ) -> httpx.AsyncClient:
+
+    """Async version of connect_mggraph_application
+
+    The client is not cached since the hishel sqlite storage is synchronous. It should be used from
+    a single event loop: pooled connections are bound to the loop they were opened in.
+
+    Args:
+        app_id (str): The Client/App id
+        secret (str): The app secret
+        tenant_id (str): The Azure tenant id
+        api_url (str, optional): The graph api url. Leave this to default unless you need the beta api. Defaults to "https://graph.microsoft.com/v1.0".
+
+    Returns:
+        httpx.AsyncClient: Httpx AsyncClient object ready to use
+    """
+
+    access_token = get_application_token(app_id, secret, tenant_id)
+
+    connection = httpx.AsyncClient(
+        base_url=api_url,
+        headers= {
+            "Authorization": f"Bearer {access_token}",
+            "ConsistencyLevel": "eventual",        # Needed for advanced queries
+        },
+        timeout=20.0,
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=50, max_connections=100)
+    )
+
+    return connection
+
+def get_application_token(app_id: str, secret: str, tenant_id: str) -> str:
+    """Fetch an application access token using the client credentials flow
+
+    Tokens are cached in memory until a minute before they expire
+
+    Args:
+        app_id (str): The Client/App id
+        secret (str): The app secret
+        tenant_id (str): The Azure tenant id
+
+    Returns:
+        str: The access token
+    """
+
+    cache_key = (tenant_id, app_id)
+
+    cached_token = token_cache.get(cache_key)
+    if cached_token and cached_token[1] - time.time() > 60:
+        return cached_token[0]
+
+    with token_lock:
+        # Another thread might have refreshed the token while we were waiting for the lock
+        cached_token = token_cache.get(cache_key)
+        if cached_token and cached_token[1] - time.time() > 60:
+            return cached_token[0]
+
+        token = response_json(login_client.post(
+            f"/{tenant_id}/oauth2/v2.0/token",
+            data={
+                "scope": "https://graph.microsoft.com/.default",
+                "grant_type": "client_credentials",
+                "client_id": app_id,
+                "client_secret": secret,
+            },
+        ))
+
+        token_cache[cache_key] = (token['access_token'], time.time() + int(token['expires_in']))
+
+        return token['access_token']